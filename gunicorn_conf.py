@@ -0,0 +1,25 @@
+"""
+gunicorn_conf.py
+
+Gunicorn settings for running the mirror in production:
+  PUB_MIRROR_CACHE_DIR=/srv/pub/packages gunicorn -c gunicorn_conf.py 'proxy_cached:create_app()'
+"""
+
+import os
+
+bind = os.environ.get('PUB_MIRROR_BIND', '0.0.0.0:9191')
+# one process per core; threads cover the time spent waiting on pub.dev and slow clients
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('PUB_MIRROR_THREADS', 32))
+keepalive = 75
+# load the app once in the master so workers share its read-only pages copy-on-write
+preload_app = True
+# send_file hands cached archives to wsgi.file_wrapper; gunicorn turns that into os.sendfile()
+sendfile = True
+accesslog = '-'
+
+def post_worker_init(worker):
+    # background threads started in the preloaded master would not survive the fork
+    import proxy_cached
+    proxy_cached.start_trash_collector(proxy_cached.app.config['CACHE_DIR'])
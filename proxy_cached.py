@@ -3,7 +3,7 @@
 proxy_cached.py
 
 Minimal pub.dev proxy that:
- - Always fetches package metadata live from pub.dev (no long-term metadata cache)
+ - Fetches package metadata from pub.dev, keeping it for a short TTL and revalidating with ETags
  - Rewrites archive_url entries to point at this proxy
  - Caches tarballs on first download (by package/version) and serves cached archives
  - Provides admin endpoints to purge or prefetch cached archives
@@ -11,22 +11,169 @@ Minimal pub.dev proxy that:
 Usage:
   python3 proxy_cached.py --host 0.0.0.0 --port 8080 --cache-dir /srv/pub/packages
 
-Requirements: Flask, requests
+In production, run it under gunicorn with settings from PUB_MIRROR_* environment variables:
+  PUB_MIRROR_CACHE_DIR=/srv/pub/packages gunicorn -c gunicorn_conf.py 'proxy_cached:create_app()'
+
+Behind nginx, pass --accel-redirect /_cached/ (with an `internal` location aliased to the
+cache dir) so cached archives are sent by nginx instead of through Python.
+
+Requirements: Flask, requests, cachetools, orjson
 """
 
 import argparse
+import errno
+import hashlib
+import http.cookiejar
+import orjson
 import os
 import requests
 import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from urllib.parse import quote
+from cachetools import LRUCache, TTLCache
 from flask import Flask, jsonify, send_file, abort, request, Response, url_for, stream_with_context
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 REAL_PUB = "https://pub.dev"
 app = Flask(__name__)
 
+UPSTREAM_POOL_SIZE = 256
+
+def mount_upstream_adapter(session, pool_size):
+    """Give session a keep-alive pool of up to pool_size connections per upstream host."""
+    adapter = HTTPAdapter(pool_connections=64, pool_maxsize=pool_size,
+                          max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=(502, 503, 504), raise_on_status=False))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+# shared upstream session so connections (and TLS handshakes) to pub.dev are reused across requests
+SESSION = requests.Session()
+# clients share it, so a cookie set in reply to one client must never be sent upstream for another
+SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+mount_upstream_adapter(SESSION, UPSTREAM_POOL_SIZE)
+UPSTREAM_TIMEOUT = 30
+# upstream requests run on this bounded pool, so a burst of clients doesn't become a burst of requests to pub.dev
+UPSTREAM_WORKERS = 32
+UPSTREAM_EXECUTOR = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix='upstream')
+# tarballs are already gzip'd; ask upstream not to wrap them in another content-encoding
+ARCHIVE_HEADERS = {'Accept-Encoding': 'identity'}
+# not forwarded from upstream: requests decodes the body and werkzeug does its own framing
+EXCLUDED_HEADERS = ('content-encoding', 'transfer-encoding', 'connection')
+# read/write size for streamed bodies; large enough that a 10 MB tarball is ~160 write(2) calls, not ~1300
+CHUNK_SIZE = 1 << 16
+
+# archive downloads in flight, keyed by (name, version); concurrent misses wait on the leader's Event
+_inflight = {}
+_inflight_lock = threading.Lock()
+DOWNLOAD_WAIT_TIMEOUT = 60
+
+# upstream metadata: path -> (etag, last_modified, body, expires); expired entries are revalidated, not dropped
+META_CACHE = LRUCache(maxsize=4096)
+_meta_lock = threading.Lock()
+META_TTL = 60
+# rewritten metadata: (path, host_url) -> (upstream body, rewritten JSON bytes), reused while the body is unchanged
+RENDERED_CACHE = LRUCache(maxsize=4096)
+
+# archive contents stored once by sha256 under cache_dir/BLOB_DIR/<aa>/<digest>; version paths are hardlinks to them
+BLOB_DIR = '.blobs'
+
+# purged directories are renamed into cache_dir/TRASH_DIR and deleted by a background thread
+TRASH_DIR = '.trash'
+TRASH_GRACE = 5
+# seconds between full scans of BLOB_DIR for blobs that lost their last link other than through a purge
+BLOB_SWEEP_INTERVAL = 3600
+_trash_thread = None
+_trash_lock = threading.Lock()
+
+# (name, version) -> upstream status for versions pub.dev recently said don't exist; stops repeat 404 storms
+MISSING_CACHE = TTLCache(maxsize=8192, ttl=30)
+_missing_lock = threading.Lock()
+MISSING_STATUSES = (404, 410)
+
 def version_dir(cache_dir, name, version):
     return os.path.join(cache_dir, name, version)
 
+# (name, version) -> sha256 hex digest (None until read, '' if unknown) for archives known to exist at
+# tar_filename(); per process, so a purge in another gunicorn worker is only noticed when the file turns
+# out to be gone (see package_archive)
+CACHE_INDEX = {}
+_index_lock = threading.Lock()
+INDEX_LOAD_LIMIT = 100000
+
+def tar_filename(cache_dir, name, version):
+    return os.path.join(version_dir(cache_dir, name, version), f"{name}-{version}.tar.gz")
+
+def blob_path(cache_dir, digest):
+    return os.path.join(cache_dir, BLOB_DIR, digest[:2], digest)
+
+def index_archive(name, version, digest=None):
+    with _index_lock:
+        if digest is not None or (name, version) not in CACHE_INDEX:
+            CACHE_INDEX[(name, version)] = digest
+
+def unindex_archive(name, version=None):
+    """Drop one version, or every version of name when version is None, from CACHE_INDEX."""
+    with _index_lock:
+        if version is not None:
+            CACHE_INDEX.pop((name, version), None)
+        else:
+            for key in [key for key in CACHE_INDEX if key[0] == name]:
+                del CACHE_INDEX[key]
+
+def load_cache_index(cache_dir):
+    """Seed CACHE_INDEX from archives already on disk, stopping after INDEX_LOAD_LIMIT entries."""
+    count = 0
+    for pkg in os.scandir(cache_dir):
+        # skips TRASH_DIR and other bookkeeping directories
+        if pkg.name.startswith('.') or not pkg.is_dir():
+            continue
+        for ver in os.scandir(pkg.path):
+            if count >= INDEX_LOAD_LIMIT:
+                return
+            if ver.is_dir() and os.path.isfile(tar_filename(cache_dir, pkg.name, ver.name)):
+                index_archive(pkg.name, ver.name)
+                count += 1
+
+def archive_digest(cache_dir, name, version):
+    """Return the sha256 hex digest recorded for a cached archive, or '' if there is none."""
+    digest = CACHE_INDEX.get((name, version))
+    if digest is None:
+        try:
+            with open(tar_filename(cache_dir, name, version) + '.sha256') as fh:
+                digest = fh.read().strip()
+        except OSError:
+            # archives cached before digests were recorded
+            digest = ''
+        with _index_lock:
+            if (name, version) in CACHE_INDEX:
+                CACHE_INDEX[(name, version)] = digest
+    return digest
+
+def write_digest(filename, digest):
+    """Record digest next to the archive at filename, replacing any previous one atomically."""
+    tmp = f"{filename}.{uuid.uuid4().hex}.sha256"
+    try:
+        with open(tmp, 'w') as fh:
+            fh.write(digest + '\n')
+        os.replace(tmp, filename + '.sha256')
+    finally:
+        remove_partial(tmp)
+
 def cached_tar_path(cache_dir, name, version):
+    filename = tar_filename(cache_dir, name, version)
+    # archives we've seen or written are served without touching the filesystem
+    if (name, version) in CACHE_INDEX:
+        return filename
+    # archives are always written under a deterministic name, so a miss in the index is a single stat
+    if os.path.isfile(filename):
+        index_archive(name, version)
+        return filename
+    # slow path for archives placed in the cache dir by hand under another name
     vd = version_dir(cache_dir, name, version)
     if not os.path.isdir(vd):
         return None
@@ -35,95 +182,473 @@ def cached_tar_path(cache_dir, name, version):
             return os.path.join(vd, f)
     return None
 
+def claim_download(key):
+    """Return (True, event) if the caller should download key itself, else (False, event) to wait on."""
+    with _inflight_lock:
+        event = _inflight.get(key)
+        if event is not None:
+            return False, event
+        event = _inflight[key] = threading.Event()
+        return True, event
+
+def release_download(key):
+    with _inflight_lock:
+        event = _inflight.pop(key, None)
+    if event is not None:
+        event.set()
+
+def missing_status(key):
+    with _missing_lock:
+        return MISSING_CACHE.get(key)
+
+def remember_missing(key, status):
+    # only definitive answers; 5xx/429 are transient and must be retried
+    if status in MISSING_STATUSES:
+        with _missing_lock:
+            MISSING_CACHE[key] = status
+
+def forget_missing(key):
+    with _missing_lock:
+        MISSING_CACHE.pop(key, None)
+
+def send_cached(tar, digest=''):
+    """Send a cached tarball, handing the transfer off to the front-end server when configured.
+
+    With a digest, the response carries ETag "sha256-<digest>" and answers a matching If-None-Match with 304.
+    """
+    etag = f'sha256-{digest}' if digest else None
+    prefix = app.config.get('ACCEL_REDIRECT')
+    if prefix:
+        # nginx would answer 404 for a stale index entry; raise like send_file so the caller refetches
+        if not os.path.isfile(tar):
+            raise FileNotFoundError(tar)
+        rel = os.path.relpath(tar, app.config['CACHE_DIR']).replace(os.sep, '/')
+        resp = Response(content_type='application/octet-stream')
+        resp.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(rel)
+        resp.headers['Content-Disposition'] = f'attachment; filename="{os.path.basename(tar)}"'
+        if etag:
+            resp.set_etag(etag)
+            if request.if_none_match.contains_weak(etag):
+                return Response(status=304, headers={'ETag': resp.headers['ETag']})
+        return resp
+    # with USE_X_SENDFILE set, send_file emits an X-Sendfile header instead of the body
+    return send_file(tar, as_attachment=True, etag=etag or True)
+
+def close_abandoned(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+def upstream_request(method, url, **kwargs):
+    """Run SESSION.request on UPSTREAM_EXECUTOR and wait for the response headers.
+
+    Raises requests.Timeout if no response arrives within UPSTREAM_TIMEOUT, queueing included. Streamed
+    bodies are still read by the calling thread.
+    """
+    future = UPSTREAM_EXECUTOR.submit(SESSION.request, method, url, timeout=UPSTREAM_TIMEOUT, **kwargs)
+    try:
+        return future.result(timeout=UPSTREAM_TIMEOUT)
+    except FuturesTimeoutError:
+        if not future.cancel():
+            # already running; release its connection whenever it does complete
+            future.add_done_callback(close_abandoned)
+        raise requests.Timeout(f'no upstream response within {UPSTREAM_TIMEOUT}s')
+
 def fetch_upstream(path, stream=False, params=None, headers=None, method='get', data=None):
     url = REAL_PUB.rstrip('/') + path
     try:
-        resp = requests.request(method, url, params=params, headers=headers, data=data, stream=stream, timeout=30)
+        resp = upstream_request(method, url, params=params, headers=headers, data=data, stream=stream)
         return resp
     except requests.RequestException as e:
         app.logger.error('Upstream fetch failed %s %s', url, e)
         return None
 
+def passthrough(r):
+    """Relay an upstream response to the client as a stream rather than buffering its body."""
+    excluded = EXCLUDED_HEADERS
+    if 'content-encoding' in r.headers:
+        # the decoded body no longer matches upstream's length
+        excluded += ('content-length',)
+    headers_out = [(name, value) for (name, value) in r.raw.headers.items() if name.lower() not in excluded]
+    resp = Response(stream_with_context(r.iter_content(chunk_size=CHUNK_SIZE)), status=r.status_code, headers=headers_out)
+    # hand the connection back to the pool even if the client goes away mid-body
+    resp.call_on_close(r.close)
+    return resp
+
+def fetch_metadata(path):
+    """Return (body, None) with the raw upstream JSON for path, or (None, r) with the failed upstream response.
+
+    r is None when upstream is unreachable. Bodies are reused for META_TTL seconds, then revalidated
+    with If-None-Match/If-Modified-Since so an unchanged package costs a 304 instead of a full download.
+    """
+    with _meta_lock:
+        cached = META_CACHE.get(path)
+    if cached and cached[3] > time.monotonic():
+        return cached[2], None
+
+    headers = {}
+    if cached and cached[0]:
+        headers['If-None-Match'] = cached[0]
+    if cached and cached[1]:
+        headers['If-Modified-Since'] = cached[1]
+    # streamed so that error bodies can be passed through without reading them here
+    r = fetch_upstream(path, stream=True, headers=headers)
+    if r is None:
+        return None, None
+    if r.status_code == 304 and cached:
+        r.close()
+        entry = (r.headers.get('ETag', cached[0]), r.headers.get('Last-Modified', cached[1]), cached[2])
+    elif r.status_code == 200:
+        try:
+            body = r.content
+        except requests.RequestException as e:
+            # the body is read after fetch_upstream returns; a truncated one is as unusable as no response
+            app.logger.error('Upstream fetch failed %s %s', path, e)
+            r.close()
+            return None, None
+        entry = (r.headers.get('ETag'), r.headers.get('Last-Modified'), body)
+    else:
+        return None, r
+    with _meta_lock:
+        META_CACHE[path] = entry + (time.monotonic() + META_TTL,)
+    return entry[2], None
+
+def render_metadata(path, body, rewrite):
+    """Return body with rewrite applied, as JSON bytes; reuses the previous rendering for this host while body is unchanged."""
+    key = (path, request.host_url)
+    with _meta_lock:
+        cached = RENDERED_CACHE.get(key)
+    # fetch_metadata hands back the same bytes object until upstream content changes
+    if cached and cached[0] is body:
+        return cached[1]
+    data = orjson.loads(body)
+    rewrite(data)
+    out = orjson.dumps(data)
+    with _meta_lock:
+        RENDERED_CACHE[key] = (body, out)
+    return out
+
 @app.route('/api/packages/<name>')
 def api_package(name):
-    """Always fetch metadata from upstream and rewrite archive_url to local when cached."""
+    """Fetch (recently cached) metadata from upstream and rewrite archive_url to point at this proxy."""
     cache_dir = app.config['CACHE_DIR']
-    r = fetch_upstream(f"/api/packages/{name}")
-    if r is None:
-        return abort(502)
-    if r.status_code != 200:
+    body, r = fetch_metadata(f"/api/packages/{name}")
+    if body is None:
+        if r is None:
+            return abort(502)
         # pass through errors
-        return Response(r.content, status=r.status_code, headers=r.headers.items())
+        return passthrough(r)
 
-    data = r.json()
-    # rewrite archive urls to our proxy; if tar cached use local URL, otherwise still point to proxy (so proxy will fetch & cache on demand)
-    for v in data.get('versions', []):
-        ver = v.get('version')
-        if not ver:
-            continue
-        # point archive_url to our proxy endpoint for this version
-        v['archive_url'] = url_for('package_archive', name=name, version=ver, _external=True)
-        # if we have a cached tar, ensure it will be used (archive_url already points to us)
-    return jsonify(data)
+    def rewrite(data):
+        # build the URL once and splice each version in; url_for per version re-walks the URL map
+        prefix, suffix = url_for('package_archive', name=name, version='__VERSION__', _external=True).rsplit('__VERSION__', 1)
+        # rewrite archive urls to our proxy; if tar cached use local URL, otherwise still point to proxy (so proxy will fetch & cache on demand)
+        for v in data.get('versions', []):
+            ver = v.get('version')
+            if not ver:
+                continue
+            # point archive_url to our proxy endpoint for this version
+            v['archive_url'] = prefix + ver + suffix
+            # if we have a cached tar, ensure it will be used (archive_url already points to us)
+    return Response(render_metadata(f"/api/packages/{name}", body, rewrite), mimetype='application/json')
 
 @app.route('/api/packages/<name>/versions/<version>.json')
 def api_package_version(name, version):
     cache_dir = app.config['CACHE_DIR']
+    status = missing_status((name, version))
+    if status:
+        return abort(status)
     # fetch upstream metadata for this exact version
-    r = fetch_upstream(f"/api/packages/{name}/versions/{version}.json")
-    if r is None:
-        return abort(502)
-    if r.status_code != 200:
-        return Response(r.content, status=r.status_code, headers=r.headers.items())
-    data = r.json()
-    # ensure archive_url points to us (so client will request our archive endpoint)
-    data['archive_url'] = url_for('package_archive', name=name, version=version, _external=True)
-    return jsonify(data)
+    body, r = fetch_metadata(f"/api/packages/{name}/versions/{version}.json")
+    if body is None:
+        if r is None:
+            return abort(502)
+        remember_missing((name, version), r.status_code)
+        return passthrough(r)
+
+    def rewrite(data):
+        # ensure archive_url points to us (so client will request our archive endpoint)
+        data['archive_url'] = url_for('package_archive', name=name, version=version, _external=True)
+    return Response(render_metadata(f"/api/packages/{name}/versions/{version}.json", body, rewrite), mimetype='application/json')
 
 @app.route('/packages/<name>/versions/<version>.tar.gz')
 def package_archive(name, version):
     """Serve cached tarball if present; otherwise stream from upstream while saving to cache."""
     cache_dir = app.config['CACHE_DIR']
+    key = (name, version)
     tar = cached_tar_path(cache_dir, name, version)
     if tar:
-        app.logger.info('Serving cached %s %s', name, version)
-        return send_file(tar, as_attachment=True)
+        try:
+            app.logger.info('Serving cached %s %s', name, version)
+            return send_cached(tar, archive_digest(cache_dir, name, version))
+        except FileNotFoundError:
+            # indexed but gone, e.g. purged by another worker; fetch it again
+            unindex_archive(name, version)
+
+    status = missing_status(key)
+    if status:
+        return abort(status)
+    deadline = time.monotonic() + DOWNLOAD_WAIT_TIMEOUT
+    while True:
+        leader, event = claim_download(key)
+        if leader or time.monotonic() >= deadline:
+            # past the deadline we fetch on our own rather than keep the client waiting
+            break
+        # another request is already downloading this version; serve its result instead of fetching twice
+        event.wait(max(0, deadline - time.monotonic()))
+        tar = cached_tar_path(cache_dir, name, version)
+        if tar:
+            app.logger.info('Serving cached %s %s', name, version)
+            return send_cached(tar, archive_digest(cache_dir, name, version))
+        # the leader may have learned that the version doesn't exist
+        status = missing_status(key)
+        if status:
+            return abort(status)
+        # the leader finished without caching it (client went away, write failed); one waiter takes over
 
     # not cached: fetch from upstream and write to disk while streaming to client
     upstream_path = f"/packages/{name}/versions/{version}.tar.gz"
-    r = fetch_upstream(upstream_path, stream=True)
-    if r is None:
-        return abort(502)
-    if r.status_code != 200:
-        return Response(r.content, status=r.status_code, headers=r.headers.items())
+    r = fetch_upstream(upstream_path, stream=True, headers=ARCHIVE_HEADERS)
+    if r is None or r.status_code != 200:
+        if leader:
+            release_download(key)
+        if r is None:
+            return abort(502)
+        remember_missing(key, r.status_code)
+        return passthrough(r)
 
-    vd = version_dir(cache_dir, name, version)
-    os.makedirs(vd, exist_ok=True)
-    filename = os.path.join(vd, f"{name}-{version}.tar.gz")
-    tmpname = filename + '.part'
+    headers = {'Content-Disposition': f'attachment; filename="{name}-{version}.tar.gz"'}
+    # an encoded body is decoded before it reaches the client, so upstream's length would be wrong
+    if 'content-length' in r.headers and 'content-encoding' not in r.headers:
+        headers['Content-Length'] = r.headers['content-length']
+
+    content_type = r.headers.get('content-type', 'application/octet-stream')
+    if request.method == 'HEAD':
+        # nothing would read the body, so don't download it just to throw it away
+        r.close()
+        if leader:
+            release_download(key)
+        resp = Response(content_type=content_type)
+        resp.headers.update(headers)
+        return resp
+
+    def stream():
+        try:
+            yield from tee_to_cache(r, cache_dir, name, version)
+        finally:
+            # wake waiters once the stream is finished and the file (if any) is in place
+            if leader:
+                release_download(key)
+
+    def close():
+        # the stream's finally never runs if the server closes the response before iterating it
+        r.close()
+        if leader:
+            release_download(key)
+
+    resp = Response(stream_with_context(stream()), headers=headers, content_type=content_type)
+    resp.call_on_close(close)
+    return resp
 
+def remove_partial(tmpname):
+    if os.path.exists(tmpname):
+        try:
+            os.remove(tmpname)
+        except Exception:
+            pass
+
+def preallocate(fd, size):
+    """Reserve size bytes for fd in one go so the archive gets contiguous extents instead of growing per chunk."""
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        # unsupported by the filesystem is fine; running out of space is a real failure
+        if e.errno == errno.ENOSPC:
+            raise
+
+def install_blob(cache_dir, tmpname, digest, filename):
+    """Store a finished download under its digest and hardlink it at filename, sharing the inode of identical archives."""
+    blob = blob_path(cache_dir, digest)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
     try:
-        with open(tmpname, 'wb') as fh:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
+        os.link(tmpname, blob)
+    except FileExistsError:
+        pass
+    # link under a temporary name first so filename is swapped atomically
+    link_tmp = f"{filename}.{uuid.uuid4().hex}.link"
+    try:
+        try:
+            os.link(blob, link_tmp)
+        except FileNotFoundError:
+            # an orphaned blob with the same digest was swept in between; use our own copy
+            os.link(tmpname, link_tmp)
+        os.replace(link_tmp, filename)
+    finally:
+        remove_partial(link_tmp)
+
+def tee_to_cache(r, cache_dir, name, version):
+    """Yield upstream archive chunks while writing them to a .part file, installed into the blob store once complete.
+
+    If the cache can't be written the chunks are still yielded, so the client download is unaffected.
+    """
+    vd = version_dir(cache_dir, name, version)
+    filename = tar_filename(cache_dir, name, version)
+    tmpname = None
+    fh = None
+    digest = hashlib.sha256()
+    # the on-disk size is only known up front when the body isn't content-encoded
+    size = 0 if 'content-encoding' in r.headers else int(r.headers.get('content-length', 0))
+    written = 0
+    try:
+        try:
+            os.makedirs(vd, exist_ok=True)
+            blobs = os.path.join(cache_dir, BLOB_DIR)
+            os.makedirs(blobs, exist_ok=True)
+            # unique name so a writer that gave up waiting never clobbers another's partial file;
+            # kept in BLOB_DIR so it is on the same filesystem as the blob it becomes
+            fd, tmpname = tempfile.mkstemp(dir=blobs, prefix=f"{name}-{version}.", suffix='.part')
+            fh = os.fdopen(fd, 'wb')
+            # mkstemp creates 0600; cached archives must stay readable by a front-end server
+            os.fchmod(fd, 0o644)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            preallocate(fd, size)
+        except OSError as e:
+            app.logger.error('Failed to cache %s %s: %s', name, version, e)
+            if fh is not None:
+                fh.close()
+                fh = None
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            if not chunk:
+                continue
+            if fh is not None:
+                try:
                     fh.write(chunk)
-                    fh.flush()
-        # move into place atomically
-        os.replace(tmpname, filename)
-        app.logger.info('Cached %s %s -> %s', name, version, filename)
-    except Exception as e:
-        app.logger.error('Failed to cache %s %s: %s', name, version, e)
-        # clean up partial
-        if os.path.exists(tmpname):
+                    digest.update(chunk)
+                    written += len(chunk)
+                except OSError as e:
+                    app.logger.error('Failed to cache %s %s: %s', name, version, e)
+                    fh.close()
+                    fh = None
+                    remove_partial(tmpname)
+            yield chunk
+        if fh is not None:
+            fh.close()
+            fh = None
+            if size and written != size:
+                # a preallocated file cut short would be padded with zeros; never install it
+                app.logger.error('Failed to cache %s %s: got %d of %d bytes', name, version, written, size)
+                return
             try:
-                os.remove(tmpname)
-            except Exception:
+                install_blob(cache_dir, tmpname, digest.hexdigest(), filename)
+                write_digest(filename, digest.hexdigest())
+                index_archive(name, version, digest.hexdigest())
+                app.logger.info('Cached %s %s -> %s', name, version, filename)
+            except OSError as e:
+                app.logger.error('Failed to cache %s %s: %s', name, version, e)
+    finally:
+        # runs on normal completion, upstream errors and client disconnects alike
+        if fh is not None:
+            fh.close()
+        r.close()
+        if tmpname:
+            remove_partial(tmpname)
+
+def trashed_digests(path):
+    """Return the blob digests recorded by the .sha256 sidecars under a trash entry."""
+    digests = set()
+    for root, _, files in os.walk(path):
+        for f in files:
+            if not f.endswith('.sha256'):
+                continue
+            try:
+                with open(os.path.join(root, f)) as fh:
+                    digest = fh.read().strip()
+            except OSError:
+                continue
+            if digest:
+                digests.add(digest)
+    return digests
+
+def release_blobs(cache_dir, digests):
+    """Delete the blobs among digests that no version path links to any more (st_nlink == 1)."""
+    for digest in digests:
+        blob = blob_path(cache_dir, digest)
+        try:
+            if os.lstat(blob).st_nlink == 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            app.logger.error('Failed to delete unreferenced blob %s: %s', blob, e)
+
+def sweep_blobs(cache_dir):
+    """Delete every blob that no version path links to any more, e.g. one replaced by a re-download with new bytes."""
+    blobs = os.path.join(cache_dir, BLOB_DIR)
+    try:
+        # in-progress .part files sit directly in BLOB_DIR and are never visited here
+        shards = [d.path for d in os.scandir(blobs) if d.is_dir()]
+    except FileNotFoundError:
+        return
+    for shard in shards:
+        try:
+            release_blobs(cache_dir, os.listdir(shard))
+        except FileNotFoundError:
+            pass
+
+def ignore_missing(func, path, exc_info):
+    # every gunicorn worker runs a collector, so another one may delete the same entry first
+    if not isinstance(exc_info[1], FileNotFoundError):
+        raise exc_info[1]
+
+def collect_trash(cache_dir):
+    trash = os.path.join(cache_dir, TRASH_DIR)
+    next_sweep = time.monotonic()
+    while True:
+        if time.monotonic() >= next_sweep:
+            # catches blobs orphaned by re-downloads, and by purges whose sidecars another collector deleted
+            sweep_blobs(cache_dir)
+            next_sweep = time.monotonic() + BLOB_SWEEP_INTERVAL
+        time.sleep(TRASH_GRACE)
+        try:
+            entries = os.listdir(trash)
+        except FileNotFoundError:
+            continue
+        digests = set()
+        for entry in entries:
+            path = os.path.join(trash, entry)
+            try:
+                # rename updates ctime; leave fresh entries alone a little longer
+                if time.time() - os.lstat(path).st_ctime < TRASH_GRACE:
+                    continue
+                # only blobs the purged archives pointed at can have lost their last link; read the
+                # sidecars first so the digests are kept even if another collector deletes the entry
+                digests |= trashed_digests(path)
+                shutil.rmtree(path, onerror=ignore_missing)
+            except FileNotFoundError:
                 pass
-        # stream upstream content directly to client
-        return Response(stream_with_context(r.iter_content(chunk_size=8192)), content_type=r.headers.get('content-type', 'application/octet-stream'))
+            except OSError as e:
+                app.logger.error('Failed to delete purged %s: %s', path, e)
+        release_blobs(cache_dir, digests)
 
-    # serve the newly cached file
-    return send_file(filename, as_attachment=True)
+def start_trash_collector(cache_dir):
+    """Start this process's trash collector if it isn't running.
+
+    Threads don't survive fork, so under gunicorn this is called per worker from gunicorn_conf.py, not from create_app().
+    """
+    global _trash_thread
+    with _trash_lock:
+        if _trash_thread is None or not _trash_thread.is_alive():
+            _trash_thread = threading.Thread(target=collect_trash, args=(cache_dir,), name='trash-collector', daemon=True)
+            _trash_thread.start()
+
+def move_to_trash(cache_dir, path):
+    """Atomically take path out of the cache; the files are deleted later by the trash collector."""
+    trash = os.path.join(cache_dir, TRASH_DIR)
+    os.makedirs(trash, exist_ok=True)
+    os.rename(path, os.path.join(trash, uuid.uuid4().hex))
+    start_trash_collector(cache_dir)
 
 @app.route('/admin/purge/<name>', methods=['POST', 'GET'])
 @app.route('/admin/purge/<name>/<version>', methods=['POST', 'GET'])
@@ -134,12 +659,14 @@ def admin_purge(name, version=None):
     if version:
         ver_dir = os.path.join(pkg_dir, version)
         if os.path.isdir(ver_dir):
-            shutil.rmtree(ver_dir)
+            move_to_trash(cache_dir, ver_dir)
+            unindex_archive(name, version)
             return jsonify({'status': 'purged', 'package': name, 'version': version})
         return jsonify({'status': 'not_found', 'package': name, 'version': version}), 404
     else:
         if os.path.isdir(pkg_dir):
-            shutil.rmtree(pkg_dir)
+            move_to_trash(cache_dir, pkg_dir)
+            unindex_archive(name)
             return jsonify({'status': 'purged', 'package': name})
         return jsonify({'status': 'not_found', 'package': name}), 404
 
@@ -147,33 +674,40 @@ def admin_purge(name, version=None):
 def admin_prefetch(name, version):
     """Fetch and cache a specific package version now (useful to pre-warm)."""
     cache_dir = app.config['CACHE_DIR']
-    # reuse package_archive logic by invoking upstream fetch and saving
-    upstream_path = f"/packages/{name}/versions/{version}.tar.gz"
-    r = fetch_upstream(upstream_path, stream=True)
-    if r is None:
-        return abort(502)
-    if r.status_code != 200:
-        return Response(r.content, status=r.status_code, headers=r.headers.items())
+    key = (name, version)
+    deadline = time.monotonic() + DOWNLOAD_WAIT_TIMEOUT
+    while True:
+        leader, event = claim_download(key)
+        if leader or time.monotonic() >= deadline:
+            break
+        # a client request is already downloading this version; its result is as fresh as ours would be
+        event.wait(max(0, deadline - time.monotonic()))
+        filename = cached_tar_path(cache_dir, name, version)
+        if filename:
+            return jsonify({'status': 'cached', 'package': name, 'version': version, 'path': filename})
 
-    vd = version_dir(cache_dir, name, version)
-    os.makedirs(vd, exist_ok=True)
-    filename = os.path.join(vd, f"{name}-{version}.tar.gz")
-    tmpname = filename + '.part'
     try:
-        with open(tmpname, 'wb') as fh:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    fh.write(chunk)
-                    fh.flush()
-        os.replace(tmpname, filename)
-        return jsonify({'status': 'cached', 'package': name, 'version': version, 'path': filename})
-    except Exception as e:
-        if os.path.exists(tmpname):
-            try:
-                os.remove(tmpname)
-            except Exception:
+        # reuse package_archive logic by invoking upstream fetch and saving
+        upstream_path = f"/packages/{name}/versions/{version}.tar.gz"
+        r = fetch_upstream(upstream_path, stream=True, headers=ARCHIVE_HEADERS)
+        if r is None:
+            return abort(502)
+        if r.status_code != 200:
+            return passthrough(r)
+
+        try:
+            for _ in tee_to_cache(r, cache_dir, name, version):
                 pass
-        return jsonify({'status': 'error', 'error': str(e)}), 500
+        except Exception as e:
+            return jsonify({'status': 'error', 'error': str(e)}), 500
+        filename = cached_tar_path(cache_dir, name, version)
+        if not filename:
+            return jsonify({'status': 'error', 'error': 'failed to write archive to cache'}), 500
+        forget_missing(key)
+        return jsonify({'status': 'cached', 'package': name, 'version': version, 'path': filename})
+    finally:
+        if leader:
+            release_download(key)
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -182,24 +716,54 @@ def proxy_fallback(path):
     upstream = REAL_PUB.rstrip('/') + '/' + path
     headers = {k: v for k, v in request.headers.items() if k.lower() != 'host'}
     try:
-        resp = requests.request(request.method, upstream, headers=headers, params=request.args, data=request.get_data(), stream=True, timeout=30)
+        resp = upstream_request(request.method, upstream, headers=headers, params=request.args, data=request.get_data(), stream=True)
     except requests.RequestException as e:
         app.logger.error('Fallback proxy error %s', e)
         return abort(502)
-    excluded = ['content-encoding', 'transfer-encoding', 'connection']
-    headers_out = [(name, value) for (name, value) in resp.raw.headers.items() if name.lower() not in excluded]
-    return Response(stream_with_context(resp.iter_content(chunk_size=8192)), status=resp.status_code, headers=headers_out)
+    return passthrough(resp)
 
-if __name__ == '__main__':
+def parse_args(argv=None):
+    """Parse command-line options; each one can also be given as a PUB_MIRROR_* environment variable."""
+    env = os.environ.get
     p = argparse.ArgumentParser()
-    p.add_argument('--host', default='0.0.0.0')
-    p.add_argument('--port', default=8080, type=int)
-    p.add_argument('--cache-dir', default='./packages')
-    p.add_argument('--upstream', default=REAL_PUB)
-    args = p.parse_args()
+    p.add_argument('--host', default=env('PUB_MIRROR_HOST', '0.0.0.0'))
+    p.add_argument('--port', default=int(env('PUB_MIRROR_PORT', 8080)), type=int)
+    p.add_argument('--cache-dir', default=env('PUB_MIRROR_CACHE_DIR', './packages'))
+    p.add_argument('--upstream', default=env('PUB_MIRROR_UPSTREAM', REAL_PUB))
+    p.add_argument('--upstream-pool-size', default=int(env('PUB_MIRROR_UPSTREAM_POOL_SIZE', UPSTREAM_POOL_SIZE)), type=int,
+                   help='keep-alive connections to keep open to the upstream host')
+    p.add_argument('--upstream-workers', default=int(env('PUB_MIRROR_UPSTREAM_WORKERS', UPSTREAM_WORKERS)), type=int,
+                   help='upstream requests allowed in flight at once; further requests queue')
+    p.add_argument('--meta-ttl', default=int(env('PUB_MIRROR_META_TTL', META_TTL)), type=int,
+                   help='seconds to reuse package metadata before revalidating upstream')
+    p.add_argument('--accel-redirect', default=env('PUB_MIRROR_ACCEL_REDIRECT'), metavar='PREFIX',
+                   help='serve cached archives via nginx X-Accel-Redirect to PREFIX (an internal location mapped to the cache dir)')
+    p.add_argument('--x-sendfile', action='store_true', default=env('PUB_MIRROR_X_SENDFILE') == '1',
+                   help='serve cached archives via X-Sendfile (Apache/lighttpd)')
+    return p.parse_args(argv)
 
+def configure(args):
+    global REAL_PUB, META_TTL, UPSTREAM_EXECUTOR
     os.makedirs(args.cache_dir, exist_ok=True)
     app.config['CACHE_DIR'] = os.path.abspath(args.cache_dir)
+    app.config['ACCEL_REDIRECT'] = args.accel_redirect
+    app.config['USE_X_SENDFILE'] = args.x_sendfile
     REAL_PUB = args.upstream.rstrip('/')
+    META_TTL = args.meta_ttl
+    mount_upstream_adapter(SESSION, args.upstream_pool_size)
+    UPSTREAM_EXECUTOR = ThreadPoolExecutor(max_workers=args.upstream_workers, thread_name_prefix='upstream')
+    load_cache_index(app.config['CACHE_DIR'])
+
+def create_app():
+    """WSGI entry point for production servers: gunicorn -c gunicorn_conf.py 'proxy_cached:create_app()'."""
+    configure(parse_args([]))
+    return app
+
+if __name__ == '__main__':
+    args = parse_args()
+    configure(args)
+    # clear out entries left in the trash by an earlier run, not only ones purged from now on
+    start_trash_collector(app.config['CACHE_DIR'])
     print(f"Starting pub mirror proxy on http://{args.host}:{args.port} with cache {app.config['CACHE_DIR']} and upstream {REAL_PUB}")
+    # development server; see gunicorn_conf.py for production
     app.run(host=args.host, port=args.port, threaded=True)